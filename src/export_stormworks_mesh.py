@@ -1,41 +1,45 @@
+import array
 from contextlib import contextmanager
-from typing import Generic, TypeVar
 
 import bpy
 import bmesh
+import numpy as np
 
-from .mesh_struct import MeshVec3, MeshVertex, SubMesh, Mesh, SubPhysMesh, PhysicsMesh
+from .mesh_struct import MESH_VERTEX_DTYPE, MeshVec3, SubMesh, SoAMesh, SubPhysMesh, PhysicsMesh
 from .utils import *
 
 
-def _vec_min(a: MeshVec3 | mathutils.Vector, b: MeshVec3 | mathutils.Vector | None) -> tuple[float, float, float]:
-    if b is None:
-        return (a.x, a.y, a.z)
-    else:
-        return (min(a.x, b.x), min(a.y, b.y), min(a.z, b.z))
-
+class _PolygonOptimizer:
+    # 三角面の角を溜めておき、最後に重複する頂点をまとめてインデックスバッファを作る
+    def __init__(self):
+        self._chunks: list[np.ndarray] = []
+        self.index_count = 0
 
-def _vec_max(a: MeshVec3 | mathutils.Vector, b: MeshVec3 | mathutils.Vector | None) -> tuple[float, float, float]:
-    if b is None:
-        return (a.x, a.y, a.z)
-    else:
-        return (max(a.x, b.x), max(a.y, b.y), max(a.z, b.z))
+    def add_vertices(self, positions: np.ndarray, colors: np.ndarray, normals: np.ndarray):
+        # (N, 3) 位置, (N, 4) 色, (N, 3) 法線
+        chunk = np.empty(len(positions), dtype=MESH_VERTEX_DTYPE)
+        chunk['position'] = positions
+        chunk['color'] = colors
+        chunk['normal'] = normals
+        self._chunks.append(chunk)
+        self.index_count += len(chunk)
 
+    def optimize(self):
+        corners = np.concatenate(self._chunks) if self._chunks else np.empty(0, dtype=MESH_VERTEX_DTYPE)
 
-T = TypeVar('T')
-class _PolygonOptimizer(Generic[T]):
-    vertices: list[T] = []
-    indices: list[int] = []
-    _vertex_index_map: dict[T, int] = {}
+        # -0.0 と 0.0 を同じ頂点とみなすため +0.0 したもののバイト列で比較する
+        keys = np.empty_like(corners)
+        keys['position'] = corners['position'] + np.float32(0.0)
+        keys['color'] = corners['color']
+        keys['normal'] = corners['normal'] + np.float32(0.0)
+        keys = keys.view(np.dtype((np.void, MESH_VERTEX_DTYPE.itemsize)))
 
-    def add_vertex(self, vertex: T):
-        if vertex in self._vertex_index_map:
-            self.indices.append(self._vertex_index_map[vertex])
-        else:
-            i = len(self.vertices)
-            self.vertices.append(vertex)
-            self._vertex_index_map[vertex] = i
-            self.indices.append(i)
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        # 最初に現れた順に頂点番号を振る
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        return corners[first[order]], rank[inverse.ravel()]
 
 
 @contextmanager
@@ -51,75 +55,163 @@ def _evaluated_mesh(obj: bpy.types.Object, depsgraph: bpy.types.Depsgraph, apply
         obj_eval.to_mesh_clear()
 
 
+_DEFAULT_COLOR = (0.6, 0.6, 0.6, 1.0)
+
+
+def _material_info(material: bpy.types.Material | None) -> tuple[int, FloatTuple4, str | None]:
+    # マテリアルから (シェーダー番号, Blender の色, 名前) を求める
+    if material is None:
+        return 0, _DEFAULT_COLOR, None
+
+    shader_id = 0
+    color = _DEFAULT_COLOR
+    if material.name == 'MATERIALglass':
+        shader_id = 1
+        color = GLASS_COLOR_BL
+    elif material.name == 'MATERIALadditive':
+        shader_id = 2
+        color = ADDITIVE_COLOR_BL
+    elif material.name == 'MATERIALlava':
+        shader_id = 3
+        color = LAVA_COLOR_BL
+
+    base_color = bsdf_base_color(material)
+    if base_color and not base_color.is_linked:
+        color = tuple(base_color.default_value) # type: ignore
+
+    return shader_id, color, material.name
+
+
 def save_mesh(ctx_objects: list[bpy.types.Object], depsgraph: bpy.types.Depsgraph, filepath: str, apply_transform=True, apply_modifiers=True, name_mode: NameModeEnum = 'NONE'):
-    submesh_triangles: dict[int, list[tuple[MeshVertex, ...]]] = {i: [] for i in range(4)}
+    # シェーダー毎に三角面の角 (位置, 色, 法線) の配列を溜める
+    submesh_corners: dict[int, list[tuple[np.ndarray, np.ndarray, np.ndarray]]] = {i: [] for i in range(4)}
     submesh_names: dict[int, str] = {}
 
     for obj in ctx_objects:
         if obj.type != 'MESH':
             continue
         with _evaluated_mesh(obj, depsgraph, apply_transform=apply_transform, apply_modifiers=apply_modifiers) as mesh:
-            # 三角面化
-            bm = bmesh.new()
-            bm.from_mesh(mesh)
-            bmesh.ops.triangulate(bm, faces=bm.faces[:])
-            bm.to_mesh(mesh)
-            bm.free()
-
-            for face in mesh.polygons:
-                material = None
-                if face.material_index < len(mesh.materials):
-                    material = mesh.materials[face.material_index]
-
-                shader_id = 0
-                color = from_blender_color((0.6, 0.6, 0.6, 1.0))
-                if material is not None:
-                    if material.name == 'MATERIALglass':
-                        shader_id = 1
-                        color = GLASS_COLOR
-                    elif material.name == 'MATERIALadditive':
-                        shader_id = 2
-                        color = ADDITIVE_COLOR
-                    elif material.name == 'MATERIALlava':
-                        shader_id = 3
-                        color = LAVA_COLOR
-
-                    base_color = bsdf_base_color(material)
-                    if base_color and not base_color.is_linked:
-                        color = from_blender_color(base_color.default_value) # type: ignore
-
-                    if name_mode == 'MATERIAL':
-                        submesh_names[shader_id] = material.name
-
-                normal = from_blender_vec(face.normal)
-
-                submesh_triangles[shader_id].append(tuple(MeshVertex(from_blender_vec(mesh.vertices[v].co), color, normal) for v in face.vertices[:3]))
-
-                if name_mode == 'MESH':
+            # 三角面化 (メッシュを書き換えずに loop_triangles を使う)
+            mesh.calc_loop_triangles()
+            n_triangles = len(mesh.loop_triangles)
+            positions_all = read_vertices(mesh)
+            face_vertices = np.empty(n_triangles * 3, dtype=np.int32)
+            mesh.loop_triangles.foreach_get('vertices', face_vertices)
+            face_vertices = face_vertices.reshape(-1, 3)
+            face_polygons = np.empty(n_triangles, dtype=np.int32)
+            mesh.loop_triangles.foreach_get('polygon_index', face_polygons)
+            face_normals = np.empty(n_triangles * 3, dtype=np.float32)
+            mesh.loop_triangles.foreach_get('normal', face_normals)
+            face_normals = face_normals.reshape(-1, 3)
+
+            # シェーダーと色は元の面毎に求め、三角面に展開する
+            n_faces = len(mesh.polygons)
+            face_materials = np.empty(n_faces, dtype=np.int32)
+            mesh.polygons.foreach_get('material_index', face_materials)
+            face_materials = np.minimum(face_materials, len(mesh.materials))
+
+            # マテリアル毎のシェーダーと色. 末尾の要素は範囲外のマテリアル番号 (マテリアル無し) 用
+            # 面が使っていないマテリアルには触れない (bsdf_base_color が use_nodes を書き換えるため)
+            no_material = (0, _DEFAULT_COLOR, None)
+            mat_info = [no_material] * (len(mesh.materials) + 1)
+            for m in np.unique(face_materials).tolist():
+                if m < len(mesh.materials):
+                    mat_info[m] = _material_info(mesh.materials[m])
+            mat_shader_ids = np.array([info[0] for info in mat_info], dtype=np.int32)
+            mat_colors = from_blender_colors([info[1] for info in mat_info])
+            mat_named = np.array([info[2] is not None for info in mat_info], dtype=bool)
+
+            face_shader_ids = mat_shader_ids[face_materials]
+            face_colors = mat_colors[face_materials]
+
+            for shader_id in np.unique(face_shader_ids).tolist():
+                if name_mode == 'MATERIAL':
+                    # そのシェーダーでマテリアルを持つ最後の面のマテリアル名
+                    faces = np.flatnonzero((face_shader_ids == shader_id) & mat_named[face_materials])
+                    if len(faces) > 0:
+                        submesh_names[shader_id] = mat_info[face_materials[faces[-1]]][2]
+                elif name_mode == 'MESH':
                     submesh_names[shader_id] = mesh.name
                 elif name_mode == 'OBJECT':
                     submesh_names[shader_id] = obj.name
 
-    poly_opt: _PolygonOptimizer[MeshVertex] = _PolygonOptimizer()
+            face_shader_ids = face_shader_ids[face_polygons]
+            face_colors = face_colors[face_polygons]
+
+            for shader_id in range(4):
+                mask = face_shader_ids == shader_id
+                if not mask.any():
+                    continue
+                positions = positions_all[face_vertices[mask].ravel()]
+                colors = np.repeat(face_colors[mask], 3, axis=0)
+                normals = np.repeat(from_blender_vecs(face_normals[mask]), 3, axis=0)
+                submesh_corners[shader_id].append((positions, colors, normals))
+
+    poly_opt = _PolygonOptimizer()
     submeshes = []
     for shader_id in range(4):
-        triangles = submesh_triangles[shader_id]
-        len_triangles = len(triangles)
+        corners = submesh_corners[shader_id]
+        if len(corners) == 0:
+            continue
+        positions = np.concatenate([c[0] for c in corners])
+        colors = np.concatenate([c[1] for c in corners])
+        normals = np.concatenate([c[2] for c in corners])
 
-        index_buffer_start = len(poly_opt.indices)
-        bounds_min, bounds_max = None, None
-        for triangle in triangles:
-            for vertex in triangle:
-                bounds_min = MeshVec3(*_vec_min(vertex.position, bounds_min))
-                bounds_max = MeshVec3(*_vec_max(vertex.position, bounds_max))
-                poly_opt.add_vertex(vertex)
+        index_buffer_start = poly_opt.index_count
+        poly_opt.add_vertices(positions, colors, normals)
 
-        if bounds_min is None or bounds_max is None:
-            continue
-        submeshes.append(SubMesh(index_buffer_start, 3 * len_triangles, shader_id, bounds_min, bounds_max, submesh_names.get(shader_id, '')))
+        bounds_min = MeshVec3._make(positions.min(axis=0).tolist())
+        bounds_max = MeshVec3._make(positions.max(axis=0).tolist())
+        submeshes.append(SubMesh(index_buffer_start, len(positions), shader_id, bounds_min, bounds_max, submesh_names.get(shader_id, '')))
 
+    vertices, indices = poly_opt.optimize()
     with open(filepath, 'wb') as f:
-        Mesh(poly_opt.vertices, poly_opt.indices, submeshes).to_writer(f)
+        SoAMesh(vertices['position'], vertices['color'], vertices['normal'], indices.astype('<u2'), submeshes).to_writer(f)
+
+
+_GRID_ORIGIN = np.array((-500.0, -500.0, -1000.0))
+_GRID_SIZE = 128.0
+
+
+def _triangle_positions(mesh: bpy.types.Mesh):
+    # 三角面毎の頂点座標 (T, 3, 3)
+    mesh.calc_loop_triangles()
+    tri_vertices = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('vertices', tri_vertices)
+    coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', coords)
+    return coords.reshape(-1, 3)[tri_vertices].reshape(-1, 3, 3)
+
+
+def _bisect_by_grid(triangles: np.ndarray):
+    # ボクセル境界をまたぐ三角面を境界の平面で分割し、分割後の三角面とボクセル番号を返す
+    bm = bmesh.new()
+    for triangle in triangles.tolist():
+        bm.faces.new([bm.verts.new(co) for co in triangle])
+
+    bounds_min = triangles.reshape(-1, 3).min(axis=0).tolist()
+    bounds_max = triangles.reshape(-1, 3).max(axis=0).tolist()
+    for ax in range(3):
+        o = _GRID_ORIGIN[ax]
+        for i in range(int((bounds_min[ax] - o)//_GRID_SIZE) + 1, int((bounds_max[ax] - o)//_GRID_SIZE) + 1):
+            co = mathutils.Vector((0, 0, 0))
+            co[ax] = o + _GRID_SIZE*i
+            no = mathutils.Vector((0, 0, 0))
+            no[ax] = 1
+            geom = bm.verts[:] + bm.edges[:] + bm.faces[:]
+            bmesh.ops.bisect_plane(bm, geom=geom, plane_co=co, plane_no=no) # type: ignore
+
+    bmesh.ops.triangulate(bm, faces=bm.faces[:])
+    pieces = np.array([[v.co[:] for v in face.verts] for face in bm.faces], dtype=np.float32).reshape(-1, 3, 3)
+    centers = np.array([face.calc_center_median()[:] for face in bm.faces], dtype=np.float64).reshape(-1, 3)
+    bm.free()
+
+    keys = np.floor((centers - _GRID_ORIGIN) / _GRID_SIZE).astype(np.int64)
+    return keys, pieces
+
+
+def _to_phys_triangles(triangles: np.ndarray) -> list[tuple[MeshVec3, ...]]:
+    return [tuple(map(MeshVec3._make, triangle)) for triangle in from_blender_vecs(triangles.reshape(-1, 3)).reshape(-1, 3, 3).tolist()]
 
 
 def save_phys(ctx_objects: list[bpy.types.Object], depsgraph: bpy.types.Depsgraph, filepath: str, apply_transform=True, apply_modifiers=True, divide_grid=True):
@@ -131,57 +223,30 @@ def save_phys(ctx_objects: list[bpy.types.Object], depsgraph: bpy.types.Depsgrap
         with _evaluated_mesh(obj, depsgraph, apply_transform=apply_transform, apply_modifiers=apply_modifiers) as mesh:
             if divide_grid:
                 # 128m のボクセルで分割
-                bounds_min, bounds_max = None, None
-                for vertex in mesh.vertices:
-                    bounds_min = mathutils.Vector(_vec_min(vertex.co, bounds_min))
-                    bounds_max = mathutils.Vector(_vec_max(vertex.co, bounds_max))
-                if bounds_min is None or bounds_max is None:
+                triangles = _triangle_positions(mesh)
+                if len(triangles) == 0:
                     continue
 
-                grid_origin = mathutils.Vector((-500, -500, -1000))
-                grid_size = mathutils.Vector((128, 128, 128))
-
-                bm = bmesh.new()
-                bm.from_mesh(mesh)
-
-                for ax in range(3):
-                    o, s = grid_origin[ax], grid_size[ax]
-                    for i in range(int((bounds_min[ax] - o)//s) + 1, int((bounds_max[ax] - o)//s) + 1):
-                        co = mathutils.Vector((0, 0, 0))
-                        co[ax] = o + s*i
-                        no = mathutils.Vector((0, 0, 0))
-                        no[ax] = 1
-                        geom = bm.verts[:] + bm.edges[:] + bm.faces[:]
-                        ret = bmesh.ops.bisect_plane(bm, geom=geom, plane_co=co, plane_no=no) # type: ignore
-
-                bmesh.ops.triangulate(bm, faces=bm.faces[:])
-                bm.to_mesh(mesh)
-                bm.free()
-
-                voxel_triangles: dict[tuple[int, int, int], list[tuple[MeshVec3, ...]]] = {}
-                for face in mesh.polygons:
-                    d = face.center - grid_origin
-                    voxel_key = (int(d.x // grid_size.x), int(d.y // grid_size.y), int(d.z // grid_size.z))
-                    if voxel_key not in voxel_triangles:
-                        voxel_triangles[voxel_key] = []
-                    voxel_triangles[voxel_key].append(tuple(from_blender_vec(mesh.vertices[v].co) for v in face.vertices[:3]))
-
-                for i, key in enumerate(sorted(voxel_triangles.keys(), key=lambda k: (k[0], k[2], k[1]))):
-                    submesh_triangles.append(voxel_triangles[key])
+                # ボクセル境界をまたぐ三角面だけを bisect で分割する
+                corner_keys = np.floor((triangles - _GRID_ORIGIN) / _GRID_SIZE).astype(np.int64)
+                spanning = (corner_keys.min(axis=1) != corner_keys.max(axis=1)).any(axis=1)
+                voxel_keys = corner_keys[~spanning, 0]
+                triangles_in_voxel = triangles[~spanning]
+                if spanning.any():
+                    bisected_keys, bisected_triangles = _bisect_by_grid(triangles[spanning])
+                    voxel_keys = np.concatenate((voxel_keys, bisected_keys))
+                    triangles_in_voxel = np.concatenate((triangles_in_voxel, bisected_triangles))
+
+                # ボクセル番号 (x, z, y) の順に並べ、同じボクセルの三角面をまとめる (ボクセル内の順序は保つ)
+                order = np.lexsort((voxel_keys[:, 1], voxel_keys[:, 2], voxel_keys[:, 0]))
+                sorted_keys = voxel_keys[order]
+                boundaries = np.flatnonzero((sorted_keys[1:] != sorted_keys[:-1]).any(axis=1)) + 1
+                for group in np.split(order, boundaries):
+                    submesh_triangles.append(_to_phys_triangles(triangles_in_voxel[group]))
 
             else:
                 # 128m ごとに分割しない
-                bm = bmesh.new()
-                bm.from_mesh(mesh)
-                bmesh.ops.triangulate(bm, faces=bm.faces[:])
-                bm.to_mesh(mesh)
-                bm.free()
-
-                triangles: list[tuple[MeshVec3, ...]] = []
-                for face in mesh.polygons:
-                    triangles.append(tuple(from_blender_vec(mesh.vertices[v].co) for v in face.vertices[:3]))
-
-                submesh_triangles.append(triangles)
+                submesh_triangles.append(_to_phys_triangles(_triangle_positions(mesh)))
 
     sub_phys_meshes: list[SubPhysMesh] = []
     for triangles in submesh_triangles:
@@ -191,7 +256,7 @@ def save_phys(ctx_objects: list[bpy.types.Object], depsgraph: bpy.types.Depsgrap
             for vertex in triangle:
                 vertices.append(vertex)
 
-        sub_phys_meshes.append(SubPhysMesh(vertices, []))
+        sub_phys_meshes.append(SubPhysMesh(vertices, array.array('I')))
 
     with open(filepath, 'wb') as f:
         PhysicsMesh(sub_phys_meshes).to_writer(f)
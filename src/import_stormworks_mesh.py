@@ -1,30 +1,48 @@
+import mmap
 from pathlib import Path
 
 import bpy
+import numpy as np
 
-from .mesh_struct import MeshColor4, Mesh, PhysicsMesh
+from .mesh_struct import MeshColor4, SoAMesh, PhysicsMesh
 from .utils import *
 
 
-def _create_mesh_object(obj_name: str, mesh_name: str, collection, vertices: list[FloatTuple3], triangles: list[IntTuple3], vertex_colors: list[FloatTuple4] | None = None, matrix=None):
+def _create_mesh_object(obj_name: str, mesh_name: str, collection, vertices: np.ndarray, triangles: np.ndarray, vertex_colors: np.ndarray | None = None, matrix=None):
+    # vertices: (N, 3) Stormworks 座標, triangles: (T, 3) 頂点番号, vertex_colors: (N, 4) uint8 の頂点色
     mesh = bpy.data.meshes.new(mesh_name)
     obj = bpy.data.objects.new(obj_name, mesh)
     collection.objects.link(obj)
-    mesh.from_pydata(vertices, [], triangles)
-    mesh.update()
+
+    n_triangles = len(triangles)
+    mesh.vertices.add(len(vertices))
+    write_vertices(mesh, vertices)
+    mesh.loops.add(3 * n_triangles)
+    mesh.loops.foreach_set('vertex_index', np.ascontiguousarray(triangles, dtype=np.int32).ravel())
+    # 面の角数は loop_start の差から決まる
+    mesh.polygons.add(n_triangles)
+    mesh.polygons.foreach_set('loop_start', np.arange(0, 3 * n_triangles, 3, dtype=np.int32))
+    mesh.update(calc_edges=True)
 
     if vertex_colors is not None:
+        # ループは三角面の順に並んでいるので、ループ -> 頂点の対応は triangles をそのまま使う
         color_layer = mesh.color_attributes.new(name='Col', type='BYTE_COLOR', domain='CORNER')
-        for polygon in mesh.polygons:
-            for loop_index in polygon.loop_indices:
-                vert_index = mesh.loops[loop_index].vertex_index
-                color_layer.data[loop_index].color = vertex_colors[vert_index] # type: ignore
+        loop_vertices = np.ascontiguousarray(triangles, dtype=np.int32).ravel()
+        color_layer.data.foreach_set('color', to_blender_colors(vertex_colors)[loop_vertices].ravel()) # type: ignore
 
     if matrix is not None:
         obj.matrix_world = matrix @ obj.matrix_world
     return obj, mesh
 
 
+# 詰めた uint32 のオーバーライド色 -> マテリアル名
+_OVERRIDE_MATERIAL_NAMES = {
+    OVERRIDE_COLOR_1.packed: 'OverrideColor1',
+    OVERRIDE_COLOR_2.packed: 'OverrideColor2',
+    OVERRIDE_COLOR_3.packed: 'OverrideColor3',
+}
+
+
 def _create_material(name: str, color: MeshColor4):
     color_tuple = to_blender_color(color)
 
@@ -43,14 +61,18 @@ def _get_material(name: str, color: MeshColor4):
     return material
 
 
-def load_mesh(file, collection, name: str, strict_mode=True):
-    with open(file, 'rb') as f:
-        mesh_data = Mesh.from_reader(f, strict=strict_mode)
+def load_mesh(file, collection, name: str, strict_mode=True, color_materials: dict[int, bpy.types.Material] | None = None):
+    with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        mesh_data = SoAMesh.from_bytes(buf, strict=strict_mode)
 
-    color_materials = {}
+    # 詰めた uint32 の色 -> マテリアル. 複数ファイルの読み込みでは共有する
+    if color_materials is None:
+        color_materials = {}
+    n_created_materials = 0
     glass_material = None
     additive_material = None
     lava_material = None
+    packed_colors = mesh_data.packed_colors
 
     for i, submesh in enumerate(mesh_data.submeshes):
         if len(mesh_data.submeshes) == 1:
@@ -68,57 +90,63 @@ def load_mesh(file, collection, name: str, strict_mode=True):
         if len(indices) == 0:
             continue
 
-        local_vertex_indices = sorted(set(indices))
-        index_map = {k: i for i, k in enumerate(local_vertex_indices)}
+        # 使われている頂点だけを取り出し、インデックスを詰め直す
+        local_vertex_indices, local_indices = np.unique(indices, return_inverse=True)
 
-        vertices = [mesh_data.vertices[i] for i in local_vertex_indices]
-        triangles = [(index_map[indices[i - 2]], index_map[indices[i - 1]], index_map[indices[i]]) for i in range(2, len(indices), 3)]
+        n_corners = len(indices) // 3 * 3
+        triangles = local_indices.ravel()[:n_corners].astype(np.int32).reshape(-1, 3)
 
-        vertices_pos = [to_blender_vec(v.position) for v in vertices]
+        vertices_pos = mesh_data.positions[local_vertex_indices]
+        vertices_color = packed_colors[local_vertex_indices]
+        # ガラス等のマテリアルは使われている最初の頂点の色で作る
+        first_color = MeshColor4.from_packed(int(vertices_color[0]))
         _, mesh = _create_mesh_object(obj_name, mesh_name, collection, vertices_pos, triangles)
 
         if submesh.shader_id == 1:
             if glass_material is None:
-                glass_material = _get_material('MATERIALglass', vertices[0].color)
+                glass_material = _get_material('MATERIALglass', first_color)
             mesh.materials.append(glass_material)
 
         elif submesh.shader_id == 2:
             if additive_material is None:
-                additive_material = _get_material('MATERIALadditive', vertices[0].color)
+                additive_material = _get_material('MATERIALadditive', first_color)
             mesh.materials.append(additive_material)
 
         elif submesh.shader_id == 3:
             if lava_material is None:
-                lava_material = _get_material('MATERIALlava', vertices[0].color)
+                lava_material = _get_material('MATERIALlava', first_color)
             mesh.materials.append(lava_material)
 
         else:
-            obj_materials = {}
-            for face, tri in zip(mesh.polygons, triangles):
-                color = vertices[tri[0]].color
-
-                if color == OVERRIDE_COLOR_1:
-                    material = _get_material('OverrideColor1', color)
-                elif color == OVERRIDE_COLOR_2:
-                    material = _get_material('OverrideColor2', color)
-                elif color == OVERRIDE_COLOR_3:
-                    material = _get_material('OverrideColor3', color)
-                elif color in color_materials:
-                    material = color_materials[color]
+            # 面の色 (先頭頂点の色を uint32 に詰めたもの) を一意化し, 出現順にマテリアルを割り当てる
+            face_colors = vertices_color[triangles[:, 0]]
+            unique_colors, first, inverse = np.unique(face_colors, return_index=True, return_inverse=True)
+            order = np.argsort(first)
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+
+            for c in unique_colors[order].tolist():
+                color = MeshColor4.from_packed(c)
+
+                override_name = _OVERRIDE_MATERIAL_NAMES.get(c)
+                if override_name is not None:
+                    material = _get_material(override_name, color)
+                elif c in color_materials:
+                    material = color_materials[c]
                 else:
-                    material = _create_material(f'{name}_{len(color_materials) + 1:02}', color)
-                    color_materials[color] = material
+                    n_created_materials += 1
+                    material = _create_material(f'{name}_{n_created_materials:02}', color)
+                    color_materials[c] = material
 
-                if color not in obj_materials:
-                    obj_materials[color] = len(obj_materials)
-                    mesh.materials.append(material)
+                mesh.materials.append(material)
 
-                face.material_index = obj_materials[color]
+            face_materials = rank[inverse.ravel()].astype(np.int32)
+            mesh.polygons.foreach_set('material_index', face_materials)
 
 
 def load_phys(file, collection, name: str, strict_mode=True):
-    with open(file, 'rb') as f:
-        phys_mesh_data = PhysicsMesh.from_reader(f, strict=strict_mode)
+    with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        phys_mesh_data = PhysicsMesh.from_bytes(buf, strict=strict_mode)
 
     for i, sub_phys in enumerate(phys_mesh_data.sub_phys_meshes):
         if len(phys_mesh_data.sub_phys_meshes) == 1:
@@ -126,14 +154,15 @@ def load_phys(file, collection, name: str, strict_mode=True):
         else:
             sub_phys_name = f'{name}_{i:02}'
 
-        triangles = [(i - 2, i - 1, i) for i in range(2, len(sub_phys.vertices), 3)]
-        _create_mesh_object(sub_phys_name, sub_phys_name, collection, [to_blender_vec(v) for v in sub_phys.vertices], triangles)
+        vertices_pos = np.array(sub_phys.vertices, dtype=np.float32).reshape(-1, 3)
+        triangles = np.arange(len(vertices_pos) // 3 * 3, dtype=np.int32).reshape(-1, 3)
+        _create_mesh_object(sub_phys_name, sub_phys_name, collection, vertices_pos, triangles)
 
 
 def load(
         mesh_type: MeshTypeEnum,
         context,
-        files=[],
+        files=(),
         directory='',
         filepath='',
         use_collection=False,
@@ -152,6 +181,7 @@ def load(
     if scene is None:
         return False
     collection = scene.collection
+    color_materials: dict[int, bpy.types.Material] = {}
 
     for file in file_paths:
         name = Path(file.name).stem
@@ -161,7 +191,7 @@ def load(
             context.view_layer.active_layer_collection = context.view_layer.layer_collection.children[collection.name]
 
         if mesh_type == 'MESH':
-            load_mesh(file, collection, name, strict_mode)
+            load_mesh(file, collection, name, strict_mode, color_materials)
         elif mesh_type == 'PHYS':
             load_phys(file, collection, name, strict_mode)
         else:
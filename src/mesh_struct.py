@@ -1,19 +1,53 @@
+import array
 from dataclasses import dataclass
 from io import BufferedReader, BufferedWriter
+import mmap
 import struct
+import sys
+from typing import NamedTuple
 
+import numpy as np
 
-def _read_unpack(reader: BufferedReader, fmt: str):
-    size = struct.calcsize(fmt)
-    return struct.unpack(fmt, reader.read(size))
 
+_S_FFF = struct.Struct('<fff')
+_S_BBBB = struct.Struct('<BBBB')
+_S_H = struct.Struct('<H')
+_S_I = struct.Struct('<I')
+_S_HH = struct.Struct('<HH')
+_S_HHHHH = struct.Struct('<HHHHH')
+# index_buffer_start, index_buffer_length, 0, shader_id, bounds_min, bounds_max, 0
+_S_SUBMESH_HEADER = struct.Struct('<IIHHffffffH')
+_SUBMESH_TRAILER = _S_FFF.pack(1.0, 1.0, 1.0)
 
-def _pack_write(writer: BufferedWriter, fmt: str, *values):
-    writer.write(struct.pack(fmt, *values))
+ReadableBuffer = bytes | bytearray | memoryview | mmap.mmap
 
 
-@dataclass(frozen=True)
-class MeshVec3:
+def _array_from_le_bytes(typecode: str, data) -> array.array:
+    # リトルエンディアンのバイト列から array を作る
+    a = array.array(typecode)
+    a.frombytes(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def _array_to_le_bytes(a: array.array) -> bytes:
+    if sys.byteorder == 'big':
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+MESH_VERTEX_DTYPE = np.dtype([('position', '<f4', (3,)), ('color', 'u1', (4,)), ('normal', '<f4', (3,))])
+
+
+def _unpack_name(buf: ReadableBuffer, offset: int):
+    # u16 の長さに続く UTF-8 文字列
+    end = offset + _S_H.size + _S_H.unpack_from(buf, offset)[0]
+    return str(buf[offset + _S_H.size:end], 'utf-8'), end
+
+
+class MeshVec3(NamedTuple):
     x: float
     y: float
     z: float
@@ -24,15 +58,13 @@ class MeshVec3:
 
     @staticmethod
     def from_reader(reader: BufferedReader):
-        x, y, z = _read_unpack(reader, '<fff')
-        return MeshVec3(x, y, z)
+        return MeshVec3._make(_S_FFF.unpack(reader.read(_S_FFF.size)))
 
     def to_writer(self, writer: BufferedWriter):
-        _pack_write(writer, '<fff', self.x, self.y, self.z)
+        writer.write(_S_FFF.pack(self.x, self.y, self.z))
 
 
-@dataclass(frozen=True)
-class MeshColor4:
+class MeshColor4(NamedTuple):
     r: int
     g: int
     b: int
@@ -40,33 +72,21 @@ class MeshColor4:
 
     @staticmethod
     def from_reader(reader: BufferedReader):
-        r, g, b, a = _read_unpack(reader, '<BBBB')
-        return MeshColor4(r, g, b, a)
-
-    def to_writer(self, writer: BufferedWriter):
-        _pack_write(writer, '<BBBB', self.r, self.g, self.b, self.a)
-
-
-@dataclass(frozen=True)
-class MeshVertex:
-    position: MeshVec3
-    color: MeshColor4
-    normal: MeshVec3
+        return MeshColor4._make(_S_BBBB.unpack(reader.read(_S_BBBB.size)))
 
     @staticmethod
-    def from_reader(reader: BufferedReader):
-        position = MeshVec3.from_reader(reader)
-        color = MeshColor4.from_reader(reader)
-        normal = MeshVec3.from_reader(reader)
-        return MeshVertex(position, color, normal)
+    def from_packed(value: int):
+        return MeshColor4._make(value.to_bytes(_S_BBBB.size, 'little'))
+
+    @property
+    def packed(self):
+        return self.r | self.g << 8 | self.b << 16 | self.a << 24
 
     def to_writer(self, writer: BufferedWriter):
-        self.position.to_writer(writer)
-        self.color.to_writer(writer)
-        self.normal.to_writer(writer)
+        writer.write(_S_BBBB.pack(self.r, self.g, self.b, self.a))
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SubMesh:
     index_buffer_start: int
     index_buffer_length: int
@@ -76,158 +96,182 @@ class SubMesh:
     name: str
 
     @staticmethod
-    def from_reader(reader: BufferedReader, strict: bool = True):
-        index_buffer_start, index_buffer_length, h2, shader_id = _read_unpack(reader, '<IIHH')
-        if strict and h2 != 0:
+    def _from_buffer_strict(buf: ReadableBuffer, offset: int):
+        index_buffer_start, index_buffer_length, h2, shader_id, x0, y0, z0, x1, y1, z1, h6 = _S_SUBMESH_HEADER.unpack_from(buf, offset)
+        if h2 != 0:
             raise ValueError(
                 f'Unexpected value. Expected 0x{0:04x}, found 0x{h2:04x}.')
-        if strict and not (0 <= shader_id <= 3):
+        if not (0 <= shader_id <= 3):
             raise ValueError(f'Unexpected shader id. Expected value between 0 and 3, found {shader_id}.')
-
-        bounds_min = MeshVec3.from_reader(reader)
-        bounds_max = MeshVec3.from_reader(reader)
-
-        h6, name_len = _read_unpack(reader, '<HH')
-        if strict and h6 != 0:
+        if h6 != 0:
             raise ValueError(
                 f'Unexpected value. Expected 0x{0:04x}, found 0x{h6:04x}.')
-        name = reader.read(name_len).decode('utf-8')
 
-        h8 = MeshVec3.from_reader(reader)
-        if strict and h8 != MeshVec3.one():
-            raise ValueError(f'Unexpected value. Expected {MeshVec3.one()}, found {h8}.')
+        name, offset = _unpack_name(buf, offset + _S_SUBMESH_HEADER.size)
 
-        return SubMesh(index_buffer_start, index_buffer_length, shader_id, bounds_min, bounds_max, name)
+        h8 = MeshVec3._make(_S_FFF.unpack_from(buf, offset))
+        if h8 != MeshVec3.one():
+            raise ValueError(f'Unexpected value. Expected {MeshVec3.one()}, found {h8}.')
 
-    def to_writer(self, writer: BufferedWriter):
-        _pack_write(writer, '<IIHH', self.index_buffer_start, self.index_buffer_length, 0, self.shader_id)
+        submesh = SubMesh(index_buffer_start, index_buffer_length, shader_id, MeshVec3(x0, y0, z0), MeshVec3(x1, y1, z1), name)
+        return submesh, offset + _S_FFF.size
 
-        self.bounds_min.to_writer(writer)
-        self.bounds_max.to_writer(writer)
+    @staticmethod
+    def _from_buffer_fast(buf: ReadableBuffer, offset: int):
+        # 検証なし 未知のフィールドは読み飛ばす
+        index_buffer_start, index_buffer_length, _, shader_id, x0, y0, z0, x1, y1, z1, _ = _S_SUBMESH_HEADER.unpack_from(buf, offset)
+        name, offset = _unpack_name(buf, offset + _S_SUBMESH_HEADER.size)
+        submesh = SubMesh(index_buffer_start, index_buffer_length, shader_id, MeshVec3(x0, y0, z0), MeshVec3(x1, y1, z1), name)
+        return submesh, offset + _S_FFF.size
 
+    def to_writer(self, writer: BufferedWriter):
+        header = _S_SUBMESH_HEADER.pack(self.index_buffer_start, self.index_buffer_length, 0, self.shader_id, *self.bounds_min, *self.bounds_max, 0)
         name_bytes = self.name.encode('utf-8')
-        _pack_write(writer, '<HH', 0, len(name_bytes))
-        writer.write(name_bytes)
-
-        MeshVec3.one().to_writer(writer)
-
-
-@dataclass(frozen=True)
-class Mesh:
-    vertices: list[MeshVertex]
-    indices: list[int]
-    # triangles: list[tuple[int, int, int]]
+        writer.write(header + _S_H.pack(len(name_bytes)) + name_bytes + _SUBMESH_TRAILER)
+
+
+def _unpack_mesh_vertex_count(buf: ReadableBuffer, strict: bool):
+    if strict and buf[0:4] != b'mesh':
+        raise ValueError('Not a valid stormworks mesh file.')
+
+    h0, h1, vertex_count, h3, h4 = _S_HHHHH.unpack_from(buf, 4)
+    if strict and h0 != 7:
+        raise ValueError(f'Unexpected value at byte offset 5-6. Expected 0x{7:04x}, found 0x{h0:04x}.')
+    if strict and h1 != 1:
+        raise ValueError(f'Unexpected value at byte offset 7-8. Expected 0x{1:04x}, found 0x{h1:04x}.')
+    if strict and h3 != 19:
+        raise ValueError(f'Unexpected value at byte offset 11-12. Expected 0x{19:04x}, found 0x{h3:04x}.')
+    if strict and h4 != 0:
+        raise ValueError(f'Unexpected value at byte offset 13-14. Expected 0x{0:04x}, found 0x{h4:04x}.')
+    return vertex_count, 4 + _S_HHHHH.size
+
+
+def _unpack_mesh_index_count(buf: ReadableBuffer, offset: int, strict: bool):
+    index_count = _S_I.unpack_from(buf, offset)[0]
+    if strict and index_count % 3 != 0:
+        raise ValueError(f'Unexpected value at field index_count. Expected a multiple of 3, found {index_count}.')
+    return index_count, offset + _S_I.size
+
+
+def _unpack_mesh_submeshes(buf: ReadableBuffer, offset: int, strict: bool):
+    submesh_count = _S_H.unpack_from(buf, offset)[0]
+    offset += _S_H.size
+    submeshes: list[SubMesh] = [None] * submesh_count # type: ignore
+    parse_submesh = SubMesh._from_buffer_strict if strict else SubMesh._from_buffer_fast
+    for i in range(submesh_count):
+        submeshes[i], offset = parse_submesh(buf, offset)
+
+    tail = _S_H.unpack_from(buf, offset)[0]
+    if strict and tail != 0:
+        raise ValueError(f'Unexpected value at the last of the data. Expected 0x{0:04x}, found 0x{tail:04x}.')
+    return submeshes
+
+
+@dataclass(frozen=True, slots=True)
+class SoAMesh:
+    # メッシュを頂点属性ごとの配列で持つ
+    positions: np.ndarray # (N, 3) float32
+    colors: np.ndarray # (N, 4) uint8
+    normals: np.ndarray # (N, 3) float32
+    indices: np.ndarray # (M,) uint16
     submeshes: list[SubMesh]
 
     @staticmethod
-    def from_reader(reader: BufferedReader, strict: bool = True):
-        if strict and reader.read(4) != b'mesh':
-            raise ValueError('Not a valid stormworks mesh file.')
-
-        h0, h1, vertex_count, h3, h4 = _read_unpack(reader, '<HHHHH')
-        if strict and h0 != 7:
-            raise ValueError(f'Unexpected value at byte offset 5-6. Expected 0x{7:04x}, found 0x{h0:04x}.')
-        if strict and h1 != 1:
-            raise ValueError(f'Unexpected value at byte offset 7-8. Expected 0x{1:04x}, found 0x{h1:04x}.')
-        if strict and h3 != 19:
-            raise ValueError(f'Unexpected value at byte offset 11-12. Expected 0x{19:04x}, found 0x{h3:04x}.')
-        if strict and h4 != 0:
-            raise ValueError(f'Unexpected value at byte offset 13-14. Expected 0x{0:04x}, found 0x{h4:04x}.')
-
-        vertices = []
-        for _ in range(vertex_count):
-            vertices.append(MeshVertex.from_reader(reader))
-
-        index_count = _read_unpack(reader, '<I')[0]
-        if strict and index_count % 3 != 0:
-            raise ValueError(f'Unexpected value at field index_count. Expected a multiple of 3, found {index_count}.')
-        indices = []
-        for _ in range(index_count):
-            v = _read_unpack(reader, '<H')[0]
-            if strict and not (0 <= v < vertex_count):
+    def from_bytes(buf: ReadableBuffer, strict: bool = True):
+        # buf が mmap の場合でも閉じられるよう、配列はコピーして保持する
+        vertex_count, offset = _unpack_mesh_vertex_count(buf, strict)
+        vertices = np.frombuffer(buf, dtype=MESH_VERTEX_DTYPE, count=vertex_count, offset=offset).copy()
+        offset += MESH_VERTEX_DTYPE.itemsize * vertex_count
+
+        index_count, offset = _unpack_mesh_index_count(buf, offset, strict)
+        indices = np.frombuffer(buf, dtype='<u2', count=index_count, offset=offset).copy()
+        offset += indices.itemsize * index_count
+        if strict and index_count > 0:
+            v = int(indices.max())
+            if v >= vertex_count:
                 raise ValueError( f'Index {v} is out of the range [{0}, {vertex_count}).')
-            indices.append(v)
-
-        submesh_count = _read_unpack(reader, '<H')[0]
-        submeshes = []
-        for _ in range(submesh_count):
-            submeshes.append(SubMesh.from_reader(reader, strict=strict))
 
-        tail = _read_unpack(reader, '<H')[0]
-        if strict and tail != 0:
-            raise ValueError(f'Unexpected value at the last of the data. Expected 0x{0:04x}, found 0x{tail:04x}.')
+        submeshes = _unpack_mesh_submeshes(buf, offset, strict)
+        return SoAMesh(vertices['position'], vertices['color'], vertices['normal'], indices, submeshes)
 
-        return Mesh(vertices, indices, submeshes)
+    @property
+    def packed_colors(self) -> np.ndarray:
+        # (N,) uint32 MeshColor4.packed と同じ並び
+        return np.ascontiguousarray(self.colors).view('<u4')[:, 0]
 
     def to_writer(self, writer: BufferedWriter):
-        writer.write(b'mesh')
-        _pack_write(writer, '<HHHHH', 7, 1, len(self.vertices), 19, 0)
+        vertices = np.empty(len(self.positions), dtype=MESH_VERTEX_DTYPE)
+        vertices['position'] = self.positions
+        vertices['color'] = self.colors
+        vertices['normal'] = self.normals
 
-        for vertex in self.vertices:
-            vertex.to_writer(writer)
+        writer.write(b'mesh')
+        writer.write(_S_HHHHH.pack(7, 1, len(vertices), 19, 0))
+        writer.write(vertices.tobytes())
 
-        _pack_write(writer, '<I', len(self.indices))
-        for v in self.indices:
-            _pack_write(writer, '<H', v)
+        writer.write(_S_I.pack(len(self.indices)))
+        writer.write(self.indices.astype('<u2', copy=False).tobytes())
 
-        _pack_write(writer, '<H', len(self.submeshes))
+        writer.write(_S_H.pack(len(self.submeshes)))
         for submesh in self.submeshes:
             submesh.to_writer(writer)
 
-        _pack_write(writer, '<H', 0)
+        writer.write(_S_H.pack(0))
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SubPhysMesh:
     vertices: list[MeshVec3]
-    indices: list[int]
+    indices: array.array
 
     @staticmethod
-    def from_reader(reader: BufferedReader):
-        vertex_count = _read_unpack(reader, '<H')[0]
-        vertices = []
-        for _ in range(vertex_count):
-            vertices.append(MeshVec3.from_reader(reader))
+    def from_buffer(buf: ReadableBuffer, offset: int):
+        vertex_count = _S_H.unpack_from(buf, offset)[0]
+        offset += _S_H.size
+        vertices: list[MeshVec3] = [None] * vertex_count # type: ignore
+        for i in range(vertex_count):
+            vertices[i] = MeshVec3._make(_S_FFF.unpack_from(buf, offset))
+            offset += _S_FFF.size
 
-        index_count = _read_unpack(reader, '<H')[0]
-        indices = []
-        for _ in range(index_count):
-            indices.append(_read_unpack(reader, '<I'))
+        index_count = _S_H.unpack_from(buf, offset)[0]
+        offset += _S_H.size
+        end = offset + _S_I.size * index_count
+        indices = _array_from_le_bytes('I', buf[offset:end])
 
-        return SubPhysMesh(vertices, indices)
+        return SubPhysMesh(vertices, indices), end
 
     def to_writer(self, writer: BufferedWriter):
-        _pack_write(writer, '<H', len(self.vertices))
+        writer.write(_S_H.pack(len(self.vertices)))
         for vertex in self.vertices:
             vertex.to_writer(writer)
 
-        _pack_write(writer, '<H', len(self.indices))
-        for index in self.indices:
-            _pack_write(writer, '<I', index)
+        writer.write(_S_H.pack(len(self.indices)))
+        writer.write(_array_to_le_bytes(self.indices))
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class PhysicsMesh:
     sub_phys_meshes: list[SubPhysMesh]
 
     @staticmethod
-    def from_reader(reader: BufferedReader, strict: bool = True):
-        if strict and reader.read(4) != b'phys':
+    def from_bytes(buf: ReadableBuffer, strict: bool = True):
+        if strict and buf[0:4] != b'phys':
             raise ValueError('Not a valid stormworks physics mesh file.')
 
-        h0, sub_phys_count = _read_unpack(reader, '<HH')
+        h0, sub_phys_count = _S_HH.unpack_from(buf, 4)
         if strict and h0 != 2:
             raise ValueError(f'Unexpected value at byte offset 5-6. Expected 0x{2:04x}, found 0x{h0:04x}.')
+        offset = 4 + _S_HH.size
 
-        sub_phys_meshes = []
-        for _ in range(sub_phys_count):
-            sub_phys_meshes.append(SubPhysMesh.from_reader(reader))
+        sub_phys_meshes: list[SubPhysMesh] = [None] * sub_phys_count # type: ignore
+        for i in range(sub_phys_count):
+            sub_phys_meshes[i], offset = SubPhysMesh.from_buffer(buf, offset)
 
         return PhysicsMesh(sub_phys_meshes)
 
     def to_writer(self, writer: BufferedWriter):
         writer.write(b'phys')
-        _pack_write(writer, '<HH', 2, len(self.sub_phys_meshes))
+        writer.write(_S_HH.pack(2, len(self.sub_phys_meshes)))
 
         for sub_phys in self.sub_phys_meshes:
             sub_phys.to_writer(writer)
@@ -1,5 +1,6 @@
 import bpy
 import mathutils
+import numpy as np
 
 from typing import Literal
 
@@ -19,28 +20,85 @@ OVERRIDE_COLOR_1 = MeshColor4(255, 125, 0, 255)
 OVERRIDE_COLOR_2 = MeshColor4(155, 125, 0, 255)
 OVERRIDE_COLOR_3 = MeshColor4(55, 125, 0, 255)
 
+# Stormworks と Blender の座標軸の対応 (y と z の入れ替え, 符号は変えない)
+AXIS_PERM = np.array((0, 2, 1))
+
+_INV255 = 1 / 255
+# uint8 -> float32 の色変換表
+_U8_TO_FLOAT = np.arange(256, dtype=np.float32) * np.float32(_INV255)
+
 
 def to_blender_vec(v: MeshVec3) -> FloatTuple3:
     return (v.x, v.z, v.y)
 
 
+def to_blender_vecs(v: np.ndarray) -> np.ndarray:
+    # (N, 3) の座標配列をまとめて変換する
+    return v[:, AXIS_PERM]
+
+
 def to_blender_color(c: MeshColor4) -> FloatTuple4:
-    return (c.r/255, c.g/255, c.b/255, c.a/255)
+    return (c.r*_INV255, c.g*_INV255, c.b*_INV255, c.a*_INV255)
+
+
+def to_blender_colors(c) -> np.ndarray:
+    # (N, 4) uint8 の色配列 (MeshColor4 のリストも可) をまとめて (N, 4) float32 に変換する
+    return _U8_TO_FLOAT[np.asarray(c, dtype=np.uint8).reshape(-1, 4)]
+
+
+# シェーダー用の固定色の Blender 表現
+GLASS_COLOR_BL = to_blender_color(GLASS_COLOR)
+ADDITIVE_COLOR_BL = to_blender_color(ADDITIVE_COLOR)
+LAVA_COLOR_BL = to_blender_color(LAVA_COLOR)
 
 
 def from_blender_vec(v: mathutils.Vector) -> MeshVec3:
     return MeshVec3(v[0], v[2], v[1])
 
 
+def from_blender_vecs(v: np.ndarray) -> np.ndarray:
+    # (N, 3) の座標配列をまとめて変換する (y と z の入れ替えなので to_blender_vecs と同じ)
+    return v[:, AXIS_PERM]
+
+
 def from_blender_color(c: FloatTuple4) -> MeshColor4:
     r, g, b, a = (min(max(round(v * 255), 0), 255) for v in c)
     return MeshColor4(r, g, b, a)
 
 
+def from_blender_colors(c) -> np.ndarray:
+    # (N, 4) の色配列をまとめて (N, 4) uint8 に変換する. 丸めは round と同じ偶数丸め
+    values = np.rint(np.asarray(c, dtype=np.float64).reshape(-1, 4) * 255)
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+
+def read_vertices(mesh: bpy.types.Mesh) -> np.ndarray:
+    # 頂点座標を Stormworks 座標の (N, 3) float32 でまとめて取得する
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', co)
+    return from_blender_vecs(co.reshape(-1, 3))
+
+
+def write_vertices(mesh: bpy.types.Mesh, v: np.ndarray):
+    # Stormworks 座標の (N, 3) を頂点にまとめて書き込む. 頂点は mesh.vertices.add(N) で確保済みであること
+    # 頂点が無いメッシュには position 属性が作られないので何もしない
+    if len(mesh.vertices) == 0:
+        return
+    co = np.ascontiguousarray(to_blender_vecs(v), dtype=np.float32)
+    mesh.attributes['position'].data.foreach_set('vector', co.ravel()) # type: ignore
+
+
 def bsdf_base_color(material: bpy.types.Material):
-    material.use_nodes = True
+    if not material.use_nodes:
+        material.use_nodes = True
     node_tree = material.node_tree
     assert node_tree is not None
+
+    # 既定の名前のノードを先に試し、見つからなければ全ノードを探す
+    node = node_tree.nodes.get('Principled BSDF')
+    if node is not None and node.type == 'BSDF_PRINCIPLED':
+        return node.inputs['Base Color']
+
     for node in node_tree.nodes:
         if node.type == 'BSDF_PRINCIPLED':
             return node.inputs['Base Color']